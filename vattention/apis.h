@@ -16,22 +16,112 @@ void show_kvcache_config() {
     vattn.show_kvcache_config();
 }
 
+/* reports must not race with (or miss) a background reclaim, so wait for it first */
 void show_allocator_state() {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
+    wait_kvcache_manager_sync();
     vattn.show_allocator_state();
 }
 
 int reserve_physical_pages(u64 free_memory) {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
     return vattn.reserve_physical_pages(free_memory);
 }
 
+/*
+ * Allocator entry points drop the GIL for their whole body. Arguments are
+ * converted to C++ types before the body runs, so nothing below touches
+ * Python objects. The RAII guard also re-acquires the GIL when the
+ * allocator throws, e.g., on OOM. With the GIL gone, memory_mapping_mutex
+ * serializes callers instead; it is held across the whole
+ * wait -> update -> spawn sequence and taken after the GIL is released
+ * so that a thread waiting for it never blocks Python.
+ */
 void step(std::vector<u64> seq_lens, bool eager_reclaim) {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
     vattn.step_sync(seq_lens, eager_reclaim);
 }
 
 void step_async(std::vector<u64> seq_lens)  {
-    Py_BEGIN_ALLOW_THREADS
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
     vattn.step_async(seq_lens);
-    Py_END_ALLOW_THREADS
+}
+
+/*
+ * seq_lens is a persistent int32 CPU tensor that the caller updates in place
+ * (e.g., with add_(1)) instead of building a new list every iteration. Other
+ * integer tensors (int64 by default, or on the GPU) are accepted too but are
+ * converted to a temporary int32 CPU copy first.
+ */
+void step_async_tensor(at::Tensor seq_lens)  {
+    TORCH_CHECK(seq_lens.dim() == 1, "seq_lens must be a 1-D tensor");
+    TORCH_CHECK(at::isIntegralType(seq_lens.scalar_type(), /*includeBool=*/false), "seq_lens must be an integer tensor");
+    if (!seq_lens.device().is_cpu() || seq_lens.scalar_type() != at::kInt || !seq_lens.is_contiguous()) {
+        TORCH_CHECK(seq_lens.numel() == 0 || seq_lens.max().item<int64_t>() <= std::numeric_limits<int32_t>::max(),
+                    "seq_lens does not fit in int32");
+        seq_lens = seq_lens.to(at::kCPU, at::kInt).contiguous();
+    }
+    const int32_t *lens = seq_lens.data_ptr<int32_t>();
+    int num_seqs = seq_lens.numel();
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
+    vattn.step_async(lens, num_seqs);
+}
+
+/*
+ * seq_lens is read in place through the buffer protocol. Arrays are bound without
+ * forcecast and with noconvert, so wrong dtypes or non-contiguous inputs are
+ * rejected (and fall through to the list overload) instead of being copied silently.
+ */
+typedef py::array_t<int32_t, py::array::c_style> int32_array;
+
+void step_async_numpy(int32_array seq_lens)  {
+    auto lens_view = seq_lens.unchecked<1>();
+    const int32_t *lens = lens_view.data(0);
+    int num_seqs = lens_view.shape(0);
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
+    vattn.step_async(lens, num_seqs);
+}
+
+/*
+ * Active requests are passed as two parallel int32 arrays, batch_ids[i] being
+ * the request id that seq_lens[i] belongs to. Inactive requests are omitted.
+ */
+int batched_num_seqs(const int32_array &batch_ids, const int32_array &seq_lens) {
+    if (batch_ids.ndim() != 1 || seq_lens.ndim() != 1)
+        throw std::runtime_error("batch_ids and seq_lens must be one-dimensional");
+    if (batch_ids.shape(0) != seq_lens.shape(0))
+        throw std::runtime_error("batch_ids and seq_lens must have the same length");
+    return seq_lens.shape(0);
+}
+
+void step_async_batched(int32_array batch_ids, int32_array seq_lens)  {
+    int num_seqs = batched_num_seqs(batch_ids, seq_lens);
+    const int32_t *ids = batch_ids.data();
+    const int32_t *lens = seq_lens.data();
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
+    vattn.step_async(ids, lens, num_seqs);
+}
+
+void step_async_range(std::vector<u64> seq_lens, int num_steps)  {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
+    vattn.step_async_range(seq_lens, num_steps);
+}
+
+void step_async_range_batched(int32_array batch_ids, int32_array seq_lens, int num_steps)  {
+    int num_seqs = batched_num_seqs(batch_ids, seq_lens);
+    const int32_t *ids = batch_ids.data();
+    const int32_t *lens = seq_lens.data();
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
+    vattn.step_async_range(ids, lens, num_seqs, num_steps);
 }
 
 void set_verbose(bool val) {
@@ -39,6 +129,8 @@ void set_verbose(bool val) {
 }
 
 void cleanup() {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
     vattn.cleanup();
 }
 
@@ -47,17 +139,34 @@ void set_deferred_reclamation(bool val) {
 }
 
 void map_common_pages(u64 num_tokens) {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
     vattn.map_common_pages_in_batch(num_tokens);
 }
 
 int alloc_new_batch_idx(unsigned long seqlen) {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
     return vattn.alloc_new_batch_idx(seqlen);
 }
 
+int alloc_and_bind(unsigned long prefill_len) {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
+    return vattn.alloc_and_bind(prefill_len);
+}
+
 void free_batch_idx(int reqId) {
+    py::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(memory_mapping_mutex);
     vattn.free_batch_idx(reqId);
 }
 
+/* lock-free; only waits if pages of finished requests are still being returned to the pool */
 u64 num_free_kvblocks() {
+    if (eager_reclaim_running) {
+        py::gil_scoped_release release;
+        wait_eager_reclaim_sync();
+    }
     return vattn.num_free_kvblocks();
 }
\ No newline at end of file
@@ -57,18 +57,57 @@ u64 do_cuda_init(int device, u64 page_size)
     return do_cuda_default_init(device, page_size);
 }
 
+/*
+ * Map pages [first, last) of the pool into a scratch range once and zero them, so that
+ * the first mapping of a page during decode does not pay for its initialization.
+ */
+void prefault_cuda_pages(u64 first, u64 last, u64 page_size)
+{
+    CUdeviceptr scratch;
+    u64 size = (last - first) * page_size;
+
+    if (size == 0)
+        return;
+
+    CHECK_CUDA(cuMemAddressReserve(&scratch, size, 0, 0, 0));
+    for (u64 i = first; i < last; i++)
+        CHECK_CUDA(cuMemMap(scratch + (i - first) * page_size, page_size, 0, cuda_pages[i], 0));
+    CHECK_CUDA(cuMemSetAccess(scratch, size, &accessDesc, 1));
+    CHECK_CUDA(cuMemsetD8(scratch, 0, size));
+    CHECK_CUDA(cuCtxSynchronize());
+    CHECK_CUDA(cuMemUnmap(scratch, size));
+    CHECK_CUDA(cuMemAddressFree(scratch, size));
+}
+
 u64 reserve_cuda_pages(u64 num_layers, u64 free_memory, u64 page_size)
 {
     Log log;
     u64 num_phys_blocks = get_num_phys_blocks(num_layers, free_memory, page_size);
     log.log("Reserving " + std::to_string(num_phys_blocks) + " pages of size " + std::to_string(page_size) + " ...");
 
+    bool flushed = false;
+    u64 first_new_page = cuda_pages.size();
     while (cuda_pages.size() < num_phys_blocks)
     {
         CUmemGenericAllocationHandle cuda_page;
-        CHECK_CUDA(cuMemCreate(&cuda_page, page_size, &prop, 0));
+        CUresult status = cuMemCreate(&cuda_page, page_size, &prop, 0);
+        /* memory cached by PyTorch's allocator may be in the way, return it to the driver and retry once */
+        if (status == CUDA_ERROR_OUT_OF_MEMORY && !flushed)
+        {
+            log.log("cuMemCreate ran out of memory, releasing PyTorch cached memory and retrying ...");
+            c10::cuda::CUDACachingAllocator::emptyCache();
+            flushed = true;
+            continue;
+        }
+        CHECK_CUDA(status);
         cuda_pages.push_back(cuda_page);
     }
+    if (is_env_flag_set("VATTENTION_PREFAULT_PAGES"))
+    {
+        log.log("Prefaulting " + std::to_string(cuda_pages.size() - first_new_page) + " pages ...");
+        prefault_cuda_pages(first_new_page, cuda_pages.size(), page_size);
+    }
+    num_free_pages.store(cuda_pages.size(), std::memory_order_relaxed);
 
     return cuda_pages.size();
 }
@@ -94,7 +133,7 @@ inline void map_cuda_pages(int reqId,
     CHECK_CUDA(cuMemMap(vcache_ptr + req_offset, page_size, 0, v_page, 0));
     CHECK_CUDA(cuMemSetAccess(kcache_ptr + req_offset, page_size, &accessDesc, 1));
     CHECK_CUDA(cuMemSetAccess(vcache_ptr + req_offset, page_size, &accessDesc, 1));
-    cuda_pagemap[std::make_tuple(reqId, req_offset, layer_idx)] = std::make_pair(k_page, v_page);
+    get_page_table_entry(batch_slots[reqId].cuda_pages, get_req_page_table_idx(reqId, req_offset, layer_idx)) = std::make_pair(k_page, v_page);
 }
 
 void do_cuda_kvcache_cleanup() {
@@ -4,6 +4,7 @@ inline CUPage pop_cuda_page() {
 
     CUPage page = cuda_pages.back();
     cuda_pages.pop_back();
+    num_free_pages.fetch_sub(1, std::memory_order_relaxed);
     return page;
 }
 
@@ -12,13 +13,12 @@ inline NvU64 pop_uvm_page() {
         throw std::runtime_error("***** uvm_page pool is empty *****");
     NvU64 page = uvm_pages.back();
     uvm_pages.pop_back();
+    num_free_pages.fetch_sub(1, std::memory_order_relaxed);
     return page;
 }
 
 static inline u64 get_num_free_pages(u64 page_size) {
-    if (is_uvm_backend(page_size))
-        return uvm_pages.size();
-    return cuda_pages.size();
+    return num_free_pages.load(std::memory_order_relaxed);
 }
 
 #define DO_KVCACHE_CLEANUP(page_size) \
@@ -32,6 +32,7 @@ static inline u64 get_num_free_pages(u64 page_size) {
             do_cuda_kvcache_cleanup(); \
             cuda_pages.clear(); \
         } \
+        num_free_pages.store(0, std::memory_order_relaxed); \
     } while (0)
 
 #define MAP_PAGES(reqId, layer_idx, req_offset, kcache_ptr, vcache_ptr, page_size) \
@@ -53,15 +54,15 @@ static inline u64 get_num_free_pages(u64 page_size) {
         if (!is_uvm_backend(page_size)) { \
             CHECK_CUDA(cuMemUnmap(kcache_ptr + req_offset, page_size)); \
             CHECK_CUDA(cuMemUnmap(vcache_ptr + req_offset, page_size)); \
-            std::pair pages = cuda_pagemap[std::make_tuple(reqId, req_offset, layer_idx)]; \
+            std::pair pages = batch_slots[reqId].cuda_pages[get_req_page_table_idx(reqId, req_offset, layer_idx)]; \
             cuda_pages.push_back(pages.first); \
             cuda_pages.push_back(pages.second); \
-            cuda_pagemap.erase(std::make_tuple(reqId, req_offset, layer_idx)); \
+            num_free_pages.fetch_add(2, std::memory_order_relaxed); \
         } else { \
-            std::pair pages = uvm_pagemap[std::make_tuple(reqId, req_offset, layer_idx)]; \
+            std::pair pages = batch_slots[reqId].uvm_pages[get_req_page_table_idx(reqId, req_offset, layer_idx)]; \
             uvm_pages.push_back(pages.first); \
             uvm_pages.push_back(pages.second); \
-            uvm_pagemap.erase(std::make_tuple(reqId, req_offset, layer_idx)); \
+            num_free_pages.fetch_add(2, std::memory_order_relaxed); \
         } \
     } while (0)
 
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 """Test script demonstrating multi-request workflow as described in documentation."""
 
+import os
 import time
 
+import numpy as np
 import torch
 import vattention
 
+# Per-step diagnostics (sequence lengths, free blocks, allocator state) are off by default
+# so that they do not interfere with timing of the allocator itself.
+VERBOSE = os.getenv("VATT_VERBOSE") == "1"
+
 
 def test_multi_request_workflow():
     """Test the multi-request workflow exactly as described in the documentation."""
@@ -21,6 +27,8 @@ def test_multi_request_workflow():
     dummy = torch.tensor([1.0], device='cuda:0')
 
     try:
+        vattention.set_verbose(VERBOSE)
+
         # Initialize KV cache for multi-request scenario
         print("\n--- Initializing KV Cache for Multi-Request Scenario ---")
         gpu_caches = vattention.init_kvcache(
@@ -49,42 +57,54 @@ def test_multi_request_workflow():
 
         # Simulate multiple requests arriving
         print("\n--- Simulating Multiple Requests Arriving ---")
-        requests = []
-        current_seq_lens = []
+        # Active requests are tracked as parallel arrays: batch_ids_np[i] owns seq_lens_np[i]
+        max_batch_size = 4
+        batch_ids_np = np.zeros(max_batch_size, dtype=np.int32)
+        seq_lens_np = np.zeros(max_batch_size, dtype=np.int32)
+        names = []
+
+        def free_slot(i):
+            """Drop active slot i in O(1) by moving the last active request into it."""
+            last = len(names) - 1
+            names[i] = names[last]
+            names.pop()
+            batch_ids_np[i] = batch_ids_np[last]
+            seq_lens_np[i] = seq_lens_np[last]
 
         # Request 1: Prefill with 512 tokens
-        batch_id_1 = vattention.alloc_new_batch_idx(512)
-        requests.append({"batch_id": batch_id_1, "seq_len": 512, "name": "Request-1"})
-        current_seq_lens.append(512)
+        batch_id_1 = vattention.alloc_and_bind(512)
+        batch_ids_np[len(names)], seq_lens_np[len(names)] = batch_id_1, 512
+        names.append("Request-1")
         print(f"Request-1: batch_id={batch_id_1}, prefill_len=512")
 
         # Request 2: Prefill with 768 tokens
-        batch_id_2 = vattention.alloc_new_batch_idx(768)
-        requests.append({"batch_id": batch_id_2, "seq_len": 768, "name": "Request-2"})
-        current_seq_lens.append(768)
+        batch_id_2 = vattention.alloc_and_bind(768)
+        batch_ids_np[len(names)], seq_lens_np[len(names)] = batch_id_2, 768
+        names.append("Request-2")
         print(f"Request-2: batch_id={batch_id_2}, prefill_len=768")
 
         # Request 3: Prefill with 256 tokens
-        batch_id_3 = vattention.alloc_new_batch_idx(256)
-        requests.append({"batch_id": batch_id_3, "seq_len": 256, "name": "Request-3"})
-        current_seq_lens.append(256)
+        batch_id_3 = vattention.alloc_and_bind(256)
+        batch_ids_np[len(names)], seq_lens_np[len(names)] = batch_id_3, 256
+        names.append("Request-3")
         print(f"Request-3: batch_id={batch_id_3}, prefill_len=256")
 
-        print(f"\\nActive requests: {len(requests)}")
-        print(f"Current sequence lengths: {current_seq_lens}")
+        num_active = len(names)
+        print(f"\\nActive requests: {num_active}")
+        print(f"Current sequence lengths: {seq_lens_np[:num_active].tolist()}")
         print(f"Free KV blocks after allocation: {vattention.num_free_kvblocks()}")
 
         # BEFORE MODEL FORWARD PASS: Allocate memory asynchronously
         print("\\n--- BEFORE Forward Pass: Asynchronous Memory Allocation ---")
         print("Calling vattention.step_async(self.curr_seq_lens)...")
-        start_time = time.time()
-        vattention.step_async(current_seq_lens)
-        async_time = time.time() - start_time
+        start_time = time.perf_counter()
+        vattention.step_async(batch_ids_np[:num_active], seq_lens_np[:num_active])
+        async_time = time.perf_counter() - start_time
         print(f"step_async completed in {async_time:.4f} seconds")
-        print(f"Free KV blocks after step_async: {vattention.num_free_kvblocks()}")
-
-        print("\\n--- Memory State After step_async ---")
-        vattention.show_allocator_state()
+        if VERBOSE:
+            print(f"Free KV blocks after step_async: {vattention.num_free_kvblocks()}")
+            print("\\n--- Memory State After step_async ---")
+            vattention.show_allocator_state()
 
         # Simulate model forward pass (just wait a bit)
         print("\\n--- Simulating Model Forward Pass ---")
@@ -94,80 +114,78 @@ def test_multi_request_workflow():
         # AFTER FORWARD PASS: Simulate decode phase (sequence growth)
         print("\\n--- AFTER Forward Pass: Decode Phase (Sequence Growth) ---")
         # Each request generates 1 more token
-        decode_seq_lens = [seq_len + 1 for seq_len in current_seq_lens]
-        print(f"Decode phase - sequences grow to: {decode_seq_lens}")
+        seq_lens_np[:num_active] += 1
+        if VERBOSE:
+            print(f"Decode phase - sequences grow to: {seq_lens_np[:num_active].tolist()}")
 
         print("Calling vattention.step_async(updated_seq_lens)...")
-        vattention.step_async(decode_seq_lens)
-        print(f"Free KV blocks after decode step: {vattention.num_free_kvblocks()}")
+        vattention.step_async(batch_ids_np[:num_active], seq_lens_np[:num_active])
+        if VERBOSE:
+            print(f"Free KV blocks after decode step: {vattention.num_free_kvblocks()}")
 
-        # Continue for a few decode steps
+        # Continue for a few decode steps, growing sequences by 1 token each
         print("\\n--- Continuing Decode Steps ---")
-        for step in range(512):
-            # Grow sequences by 1 token each
-            decode_seq_lens = [seq_len + 1 for seq_len in decode_seq_lens]
-            current_seq_lens = decode_seq_lens.copy()
-
-            print(f"Decode step {step + 2}: sequences = {decode_seq_lens}")
-            vattention.step_async(decode_seq_lens)
+        num_decode_steps = 512
+        vattention.step_async_range(batch_ids_np[:num_active], seq_lens_np[:num_active], num_decode_steps)
+        seq_lens_np[:num_active] += num_decode_steps
 
-            # Show memory usage every few steps
-            if step % 2 == 0:
-                print(f"  Free KV blocks: {vattention.num_free_kvblocks()}")
-
-        print(f"\\nAfter {5} decode steps, final sequence lengths: {decode_seq_lens}")
-        print(f"Free KV blocks: {vattention.num_free_kvblocks()}")
+        print(f"\\nAfter {num_decode_steps} decode steps, final sequence lengths: {seq_lens_np[:num_active].tolist()}")
+        if VERBOSE:
+            print(f"Free KV blocks: {vattention.num_free_kvblocks()}")
 
         # Simulate request completion - Request 1 completes first
         print("\\n--- Request Completion: Request-1 Finished ---")
-        completed_request = requests[0]
-        print(f"Calling vattention.free_batch_idx({completed_request['batch_id']}) for {completed_request['name']}")
-        vattention.free_batch_idx(completed_request['batch_id'])
-
-        # Remove completed request from tracking
-        requests = requests[1:]  # Remove first request
-        decode_seq_lens = decode_seq_lens[1:]  # Remove corresponding seq_len
+        print(f"Calling vattention.free_batch_idx({batch_ids_np[0]}) for {names[0]}")
+        vattention.free_batch_idx(int(batch_ids_np[0]))
 
-        print(f"Remaining requests: {[req['name'] for req in requests]}")
-        print(f"Remaining sequence lengths: {decode_seq_lens}")
-        print(f"Free KV blocks after request completion: {vattention.num_free_kvblocks()}")
+        # Remove completed request from tracking, keeping active slots densely packed
+        free_slot(0)
+        num_active = len(names)
 
-        print("\\n--- Memory State After Request Completion ---")
-        vattention.show_allocator_state()
+        print(f"Remaining requests: {names}")
+        print(f"Remaining sequence lengths: {seq_lens_np[:num_active].tolist()}")
+        if VERBOSE:
+            print(f"Free KV blocks after request completion: {vattention.num_free_kvblocks()}")
+            print("\\n--- Memory State After Request Completion ---")
+            vattention.show_allocator_state()
 
         # Continue with remaining requests
         print("\\n--- Continuing with Remaining Requests ---")
-        for step in range(512):
-            decode_seq_lens = [seq_len + 1 for seq_len in decode_seq_lens]
-            print(f"Decode step {step + 1}: remaining sequences = {decode_seq_lens}")
-            vattention.step_async(decode_seq_lens)
-
-        print(f"Free KV blocks: {vattention.num_free_kvblocks()}")
+        vattention.step_async_range(batch_ids_np[:num_active], seq_lens_np[:num_active], num_decode_steps)
+        seq_lens_np[:num_active] += num_decode_steps
+        print(f"After {num_decode_steps} decode steps: remaining sequences = {seq_lens_np[:num_active].tolist()}")
+        if VERBOSE:
+            print(f"Free KV blocks: {vattention.num_free_kvblocks()}")
 
         # Test synchronous allocation alternative
         print("\\n--- Testing Synchronous Alternative ---")
         print("Using vattention.step(seq_lens, eager_reclaim) instead of step_async...")
-        decode_seq_lens = [seq_len + 2 for seq_len in decode_seq_lens]
-
-        start_time = time.time()
-        vattention.step(decode_seq_lens, True)  # eager_reclaim=True
-        sync_time = time.time() - start_time
+        seq_lens_np[:num_active] += 2
+        # step() expects one entry per batch id
+        step_seq_lens = np.zeros(max_batch_size, dtype=np.int32)
+        step_seq_lens[batch_ids_np[:num_active]] = seq_lens_np[:num_active]
+
+        start_time = time.perf_counter()
+        vattention.step(step_seq_lens.tolist(), True)  # eager_reclaim=True
+        sync_time = time.perf_counter() - start_time
         print(f"step (synchronous) with eager_reclaim=True completed in {sync_time:.4f} seconds")
-        print(f"Free KV blocks after sync step: {vattention.num_free_kvblocks()}")
+        if VERBOSE:
+            print(f"Free KV blocks after sync step: {vattention.num_free_kvblocks()}")
 
         # Complete remaining requests
         print("\\n--- Completing All Remaining Requests ---")
-        for req in requests:
-            print(f"Completing {req['name']} (batch_id={req['batch_id']})")
-            vattention.free_batch_idx(req['batch_id'])
+        for name, batch_id in zip(names, batch_ids_np[:num_active].tolist()):
+            print(f"Completing {name} (batch_id={batch_id})")
+            vattention.free_batch_idx(batch_id)
 
         final_free_blocks = vattention.num_free_kvblocks()
         print(f"\\nAll requests completed!")
         print(f"Final free KV blocks: {final_free_blocks}")
-        print(f"Memory reclaimed: {final_free_blocks - (initial_free_blocks - len(requests) - 1)} blocks")
+        print(f"Memory reclaimed: {final_free_blocks - (initial_free_blocks - num_active - 1)} blocks")
 
-        print("\\n--- Final Memory State ---")
-        vattention.show_allocator_state()
+        if VERBOSE:
+            print("\\n--- Final Memory State ---")
+            vattention.show_allocator_state()
 
         print(f"\\n=== Performance Summary ===")
         print(f"Asynchronous allocation time: {async_time:.4f}s")
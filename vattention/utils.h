@@ -11,6 +11,8 @@
 #define PAGES_TO_KVBLOCKS(pages) ((pages) / (2 * (num_layers)))
 #define ROUND_UP(x, y) ((((x) + (y) - 1) / (y)) * (y))
 #define PAGES_TO_KVBLOCKS_MEGACACHE(pages) ((pages) / 2)
+/* alignment of each KV cache head row with VATTENTION_ALIGN_KV=1, for coalesced accesses */
+#define KV_ALIGN_BYTES (256)
 bool verbose = false;
 
 typedef long long unsigned int NvU64;
@@ -20,17 +22,40 @@ CUcontext ctx;
 CUmemAllocationProp prop = {};
 CUmemAccessDesc accessDesc = {};
 typedef CUmemGenericAllocationHandle CUPage;
+/*
+ * The page pools below are flat LIFO free-lists on purpose: all pages have the same size
+ * (page_size), every KV cache tensor derives tokens_per_page from it, and a request grows
+ * one page at a time at a page_size aligned offset. There is nothing to split or coalesce,
+ * so a buddy allocator would only add bookkeeping. Mixing page sizes would require a
+ * per-request tokens_per_page and a separate virtual layout per size class.
+ */
 // physical memory pages for non-uvm backend (default)
 std::vector<CUmemGenericAllocationHandle> cuda_pages;
 // physical memory pages for uvm backend (custom driver)
 std::vector<NvU64> uvm_pages;
+/*
+ * Size of the active page pool, maintained on every push/pop so that num_free_kvblocks
+ * can read it without taking memory_mapping_mutex. Such a read may be stale while the
+ * step_async mapper is running, by at most the pages the current step still needs.
+ * A pending eager reclaim is the exception: its pages belong to finished requests, so
+ * readers wait for it (eager_reclaim_running) rather than under-report the pool.
+ */
+std::atomic<u64> num_free_pages(0);
 
-using cudaPhysPageMap = std::map<std::tuple<u64, u64, u64>, std::pair<CUPage, CUPage>>;
-using uvmPhysPageMap = std::map<std::tuple<u64, u64, u64>, std::pair<NvU64, NvU64>>;
+/*
+ * Per-request page table that tracks physical memory pages (required while unmapping).
+ * Entries are indexed by page index within the request and layer. A table grows (by
+ * doubling) only as far as its longest request so far and keeps its capacity when the
+ * request finishes, so steady-state mapping and unmapping never allocates while host
+ * memory stays bounded by what has actually been mapped.
+ */
+struct BatchSlot
+{
+    std::vector<std::pair<CUPage, CUPage>> cuda_pages;
+    std::vector<std::pair<NvU64, NvU64>> uvm_pages;
+};
 
-// track physical memory pages (required while unmapping)
-cudaPhysPageMap cuda_pagemap;
-uvmPhysPageMap uvm_pagemap;
+std::vector<BatchSlot> batch_slots;
 
 std::vector<CUdeviceptr> k_ptr;
 std::vector<CUdeviceptr> v_ptr;
@@ -41,13 +66,16 @@ std::vector<at::Tensor> v_tensors;
 
 // this synchronizes background daemons with API calls
 std::atomic<bool> mem_manager_running(false);
+// set while the background thread is an eager reclaim, i.e., returning pages of finished requests
+std::atomic<bool> eager_reclaim_running(false);
 
-// mutex to protect memory mapping operations from race conditions
+// serializes allocator API calls from Python threads (the background thread is synced via mem_manager_running)
 std::mutex memory_mapping_mutex;
 
 /* model specifc params */
 int num_kv_heads;
 int head_size;
+int padded_head_size; // head_size rounded up for aligned KV cache rows, if enabled
 int num_layers;
 int bytes_per_elem;
 int device;
@@ -69,6 +97,9 @@ u64 tokens_per_page; // number of elements per physical block
 /* a request can be allocated only this many pages per vtensor */
 u64 max_pages_per_req;
 
+/* number of layers that are mapped separately, i.e., 1 with megacache */
+int num_mapped_layers;
+
 /* physical memory metadata */
 std::vector<u64> mapped_pages;     // per request allocated block count
 std::vector<u64> curr_seq_lengths; // per request allocated block count
@@ -90,10 +121,12 @@ static inline bool is_uvm_backend(u64 page_size)
     return page_size != 2 * MB;
 }
 
-void init_kvcache_batch_metadata()
+void init_kvcache_batch_metadata(int nr_mapped_layers)
 {
+    num_mapped_layers = nr_mapped_layers;
     mapped_pages.resize(max_batch_size);
     curr_seq_lengths.resize(max_batch_size);
+    batch_slots.resize(max_batch_size);
     for (int i = 0; i < max_batch_size; i++)
     {
         curr_seq_lengths[i] = 0;
@@ -101,6 +134,19 @@ void init_kvcache_batch_metadata()
     }
 }
 
+bool is_env_flag_set(const char *name)
+{
+    const char *val = std::getenv(name);
+    return val != nullptr && std::string(val) == "1";
+}
+
+int get_padded_head_size(int head_size, int bytes_per_elem)
+{
+    if (!is_env_flag_set("VATTENTION_ALIGN_KV"))
+        return head_size;
+    return ROUND_UP(head_size * bytes_per_elem, KV_ALIGN_BYTES) / bytes_per_elem;
+}
+
 bool check_kvcache_config()
 {
     return !(num_layers == 0 || num_kv_heads == 0 || head_size == 0 ||
@@ -142,6 +188,25 @@ inline u64 get_req_begin_offset_virt(int reqId)
     return reqId * virt_buff_size_per_req;
 }
 
+inline u64 get_req_page_table_idx(int reqId, u64 req_offset, int layer_idx)
+{
+    u64 page_idx = (req_offset - get_req_begin_offset_virt(reqId)) / page_size;
+    return page_idx * num_mapped_layers + layer_idx;
+}
+
+/* return the page table entry at idx, growing the table if this page was never mapped before */
+template <typename T>
+inline T &get_page_table_entry(std::vector<T> &table, u64 idx)
+{
+    if (idx >= table.size())
+    {
+        u64 max_entries = max_pages_per_req * num_mapped_layers;
+        u64 new_size = table.size() * 2 > idx + 1 ? table.size() * 2 : idx + 1;
+        table.resize(new_size < max_entries ? new_size : max_entries);
+    }
+    return table[idx];
+}
+
 inline bool is_active_req(int reqId)
 {
     return curr_seq_lengths[reqId] != 0;
@@ -160,12 +225,71 @@ inline void set_req_seq_length(int reqId, u64 seq_len)
 inline void set_curr_seq_lengths(std::vector<u64> seq_lens)
 {
     curr_seq_lengths = seq_lens;
+    /* the framework may pass fewer entries than max_batch_size; treat the rest as inactive */
+    curr_seq_lengths.resize(max_batch_size, 0);
+}
+
+/*
+ * Lengths coming in through raw int32 buffers skip pybind's unsigned caster, so reject
+ * negative values (they would wrap into huge u64 lengths) and oversized batches here.
+ */
+inline void check_seq_lengths(const int32_t *seq_lens, int num_seqs)
+{
+    if (num_seqs > max_batch_size)
+        throw std::runtime_error("***** too many sequences: " + std::to_string(num_seqs) + " (max_batch_size: " + std::to_string(max_batch_size) + ") *****");
+    for (int i = 0; i < num_seqs; i++)
+        if (seq_lens[i] < 0)
+            throw std::runtime_error("***** invalid sequence length: " + std::to_string(seq_lens[i]) + " *****");
+}
+
+/* update sequence lengths in place, without materializing a new vector */
+inline void set_curr_seq_lengths(const int32_t *seq_lens, int num_seqs)
+{
+    check_seq_lengths(seq_lens, num_seqs);
+    for (int reqId = 0; reqId < max_batch_size; reqId++)
+        curr_seq_lengths[reqId] = reqId < num_seqs ? seq_lens[reqId] : 0;
+}
+
+/*
+ * Expand a dense list of active requests, given as parallel arrays, into one
+ * sequence length per batch id. Requests that are not listed get length 0.
+ * Nothing is written to the output if any batch id is out of range or repeated.
+ */
+inline void scatter_seq_lengths(const int32_t *batch_ids, const int32_t *seq_lens, int num_seqs, std::vector<u64> &out)
+{
+    check_seq_lengths(seq_lens, num_seqs);
+    std::vector<bool> seen(max_batch_size, false);
+    for (int i = 0; i < num_seqs; i++)
+    {
+        if (batch_ids[i] < 0 || batch_ids[i] >= max_batch_size)
+            throw std::runtime_error("***** invalid batch id: " + std::to_string(batch_ids[i]) + " *****");
+        if (seen[batch_ids[i]])
+            throw std::runtime_error("***** duplicate batch id: " + std::to_string(batch_ids[i]) + " *****");
+        seen[batch_ids[i]] = true;
+    }
+
+    out.assign(max_batch_size, 0);
+    for (int i = 0; i < num_seqs; i++)
+        out[batch_ids[i]] = seq_lens[i];
+}
+
+/* same as above but for a dense list of active requests given as parallel arrays */
+inline void set_curr_seq_lengths(const int32_t *batch_ids, const int32_t *seq_lens, int num_seqs)
+{
+    scatter_seq_lengths(batch_ids, seq_lens, num_seqs, curr_seq_lengths);
 }
 
 inline void wait_kvcache_manager_sync()
 {
+    /* yield instead of busy-spinning so that the background thread is not starved of CPU */
     while (mem_manager_running)
-        ;
+        std::this_thread::yield();
+}
+
+inline void wait_eager_reclaim_sync()
+{
+    while (eager_reclaim_running)
+        std::this_thread::yield();
 }
 
 inline void set_seq_lengths_for_next_step(std::vector<u64> seq_lens)
@@ -237,6 +237,7 @@ u64 reserve_uvm_pages(u64 num_layers, u64 free_memory, u64 page_size)
         CHECK_VATTN(vattn_get_mem_page(&uvm_page));
         uvm_pages.push_back(uvm_page);
     }
+    num_free_pages.store(uvm_pages.size(), std::memory_order_relaxed);
 
     return uvm_pages.size();
 }
@@ -250,12 +251,12 @@ inline void map_uvm_pages(int reqId,
                         NvU64 v_page) {
     CHECK_VATTN(vattn_mem_map((void*)(kcache_ptr + req_offset), k_page));
     CHECK_VATTN(vattn_mem_map((void*)(vcache_ptr + req_offset), v_page));
-    uvm_pagemap[std::make_tuple(reqId, req_offset, layer_idx)] = std::make_pair(k_page, v_page);
+    get_page_table_entry(batch_slots[reqId].uvm_pages, get_req_page_table_idx(reqId, req_offset, layer_idx)) = std::make_pair(k_page, v_page);
 }
 
 /* NOTE: This function must be called after wait_kvcache_manager_sync */
 void do_uvm_kvcache_cleanup() {
-    u64 nelements = (max_batch_size * max_context_length * num_kv_heads * head_size);
+    u64 nelements = (max_batch_size * max_context_length * num_kv_heads * padded_head_size);
     for(int j = 0; j < k_tensors.size(); j++) {
         CHECK_VATTN(vattn_free_reserved_address((void*)(k_tensors[j].data_ptr()), k_tensors[j].element_size() * nelements));
         CHECK_VATTN(vattn_free_reserved_address((void*)(v_tensors[j].data_ptr()), v_tensors[j].element_size() * nelements));
@@ -13,6 +13,7 @@
 #include <cuda_runtime.h>
 #include <cuda.h>
 #include <Python.h>
+#include <pybind11/numpy.h>
 #include <utility>
 
 #include <thread>
@@ -41,9 +42,9 @@ public:
     {
         page_size = do_cuda_init(device, page_size);
         if (megacache_enabled)
-            tokens_per_page = page_size / (num_kv_heads * head_size * bytes_per_elem * num_layers);
+            tokens_per_page = page_size / (num_kv_heads * padded_head_size * bytes_per_elem * num_layers);
         else
-            tokens_per_page = page_size / (num_kv_heads * head_size * bytes_per_elem);
+            tokens_per_page = page_size / (num_kv_heads * padded_head_size * bytes_per_elem);
         log.log("Initialized CUDA context and memory config etc...");
         log.log("num_tokens_per_kvblock: " + std::to_string(tokens_per_page));
     }
@@ -53,9 +54,9 @@ public:
         u64 remainder;
 
         if (megacache_enabled)
-            virt_buff_size_per_token = num_kv_heads * head_size * bytes_per_elem * num_layers;
+            virt_buff_size_per_token = num_kv_heads * padded_head_size * bytes_per_elem * num_layers;
         else
-            virt_buff_size_per_token = num_kv_heads * head_size * bytes_per_elem;
+            virt_buff_size_per_token = num_kv_heads * padded_head_size * bytes_per_elem;
         virt_buff_size_per_req = virt_buff_size_per_token * max_context_length;
         virt_buff_size_per_req = ROUND_UP(virt_buff_size_per_req, page_size);
 
@@ -78,7 +79,7 @@ public:
     inline void show_allocator_state()
     {
         std::stringstream ss;
-        u64 nr_pages = !is_uvm_backend(page_size) ? cuda_pages.size() : uvm_pages.size();
+        u64 nr_pages = get_num_free_pages(page_size);
         if (megacache_enabled)
             log.log("Free pool: " + std::to_string(PAGES_TO_KVBLOCKS_MEGACACHE(nr_pages)) + " KV blocks");
         else
@@ -121,9 +122,10 @@ public:
         // Pre-convert dtype to scalar type to avoid GIL issues during async operations
         scalar_type = torch::python::detail::py_object_to_dtype(dtype_);
         bytes_per_elem = dtype_.attr("itemsize").cast<int>();
+        padded_head_size = get_padded_head_size(head_size, bytes_per_elem);
         init_kv_block_size();
         init_buffer_sizes();
-        init_kvcache_batch_metadata();
+        init_kvcache_batch_metadata(megacache_enabled ? 1 : num_layers);
         k_ptr.resize(num_layers);
         v_ptr.resize(num_layers);
         allocator = new VirtualTensorAllocator(device, page_size);
@@ -135,6 +137,7 @@ public:
         log.log("Num layers: " + std::to_string(num_layers));
         log.log("Num kv_heads: " + std::to_string(num_kv_heads));
         log.log("Head size: " + std::to_string(head_size));
+        log.log("Padded head size: " + std::to_string(padded_head_size));
         log.log("Max batch size: " + std::to_string(max_batch_size));
         log.log("Max context length: " + std::to_string(max_context_length));
         log.log("Bytes per elem: " + std::to_string(bytes_per_elem));
@@ -144,11 +147,11 @@ public:
 
     at::Tensor alloc_virtual_tensor()
     {
-        at::IntArrayRef shape;
+        std::vector<int64_t> shape;
         if (megacache_enabled)
-            shape = {max_batch_size, max_context_length, num_layers, num_kv_heads, head_size};
+            shape = {max_batch_size, max_context_length, num_layers, num_kv_heads, padded_head_size};
         else
-            shape = {max_batch_size, max_context_length, num_kv_heads, head_size};
+            shape = {max_batch_size, max_context_length, num_kv_heads, padded_head_size};
 
         at::Tensor t = alloc_vtensor(shape, page_size, scalar_type, allocator, device);
         return t;
@@ -182,14 +185,19 @@ public:
                 v_tensors.push_back(t);
             }
         }
+        /* hide the alignment padding from the framework, views share the same base address */
         std::vector<at::Tensor> tensors;
-        tensors.insert(tensors.end(), k_tensors.begin(), k_tensors.end());
-        tensors.insert(tensors.end(), v_tensors.begin(), v_tensors.end());
+        for (auto &t : k_tensors)
+            tensors.push_back(t.narrow(-1, 0, head_size));
+        for (auto &t : v_tensors)
+            tensors.push_back(t.narrow(-1, 0, head_size));
         return tensors;
     }
 
     u64 reserve_physical_pages(u64 free_memory)
     {
+        /* the background thread pops from the page pool that is (re)filled here */
+        wait_kvcache_manager_sync();
         return reserve_gpu_pages(num_layers, free_memory, page_size);
     }
 
@@ -285,12 +293,12 @@ public:
             verbose = true;
             if (megacache_enabled)
             {
-                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS_MEGACACHE(cuda_pages.size())));
+                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS_MEGACACHE(get_num_free_pages(page_size))));
                 log.log("required: " + std::to_string(num_blocks));
             }
             else
             {
-                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS(cuda_pages.size())));
+                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS(get_num_free_pages(page_size))));
                 log.log("required: " + std::to_string(num_blocks));
             }
             show_allocator_state();
@@ -334,16 +342,18 @@ public:
         if (num_blocks <= 0)
             return;
 
+        wait_kvcache_manager_sync();
+
         if (!kvblocks_available(num_blocks))
         {
             if (megacache_enabled)
             {
-                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS_MEGACACHE(cuda_pages.size())));
+                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS_MEGACACHE(get_num_free_pages(page_size))));
                 log.log("required: " + std::to_string(num_blocks));
             }
             else
             {
-                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS(cuda_pages.size())));
+                log.log("free pages: " + std::to_string(PAGES_TO_KVBLOCKS(get_num_free_pages(page_size))));
                 log.log("required: " + std::to_string(num_blocks));
             }
             throw std::runtime_error("***** OOM on demand: not enough free pages to continue *****");
@@ -396,18 +406,54 @@ public:
     /* This is not meant for final use but to test vattention with sync allocation */
     void step_sync(std::vector<u64> seq_lens, bool eager_reclaim)
     {
+        /* an eager reclaim from the previous step may still be running */
+        wait_kvcache_manager_sync();
+        bool reclaim_pending = false;
+        seq_lens.resize(max_batch_size, 0);
         for (int reqId = 0; reqId < max_batch_size; reqId++)
         {
             /* set the sequence length based on latest values coming from the framework */
             set_req_seq_length(reqId, seq_lens[reqId]);
-            /* request not active but physical memory blocks are allocated */
+            /* request not active but physical memory blocks are allocated, release them in the background */
             if (eager_reclaim == true and (seq_lens[reqId] == 0 && mapped_pages[reqId] != 0))
             {
-                release_kvcache_pages_all(reqId);
+                reclaim_pending = true;
                 continue;
             }
             map_pages_for_curr_step(reqId, seq_lens[reqId]);
         }
+
+        if (reclaim_pending)
+            spawn_eager_reclaim();
+    }
+
+    /* release all pages of inactive requests */
+    void do_eager_reclaim()
+    {
+        for (int reqId = 0; reqId < max_batch_size; reqId++)
+        {
+            if (is_active_req(reqId) || get_req_pages(reqId) == 0)
+                continue;
+            release_kvcache_pages_all(reqId);
+        }
+    }
+
+    /*
+     * Unmapping is a synchronous driver call, so it is handed off to a background
+     * thread and the caller returns immediately. Pages of inactive requests are
+     * therefore back in the free pool only once the next API call has synced with
+     * this thread; num_free_kvblocks and show_allocator_state wait for it too.
+     */
+    void spawn_eager_reclaim()
+    {
+        eager_reclaim_running = true;
+        mem_manager_running = true;
+        std::thread([this]()
+                    {
+            do_eager_reclaim();
+            eager_reclaim_running = false;
+            mem_manager_running = false; })
+            .detach();
     }
 
     /* Ensure that we have enough pages for each new sequence */
@@ -539,26 +585,79 @@ public:
 
     void spawn_kvcache_manager()
     {
+        /* set before spawning so that a subsequent wait cannot miss the thread */
+        mem_manager_running = true;
         std::thread([this]()
                     {
-            mem_manager_running = true;
             do_kvcache_memory_management();
             mem_manager_running = false; })
             .detach();
     }
 
-    /* single step for asynchronous allocation */
+    /*
+     * single step for asynchronous allocation. Pages for the next decode step are
+     * mapped by a background thread while the model runs its forward pass; mapping
+     * is done with host-side driver calls, so there is no device work for the
+     * forward pass to wait on, only this host-side handshake at the next step.
+     *
+     * For the same reason there is nothing here to capture in a CUDA graph. The
+     * framework may capture its own forward pass, since KV cache addresses never
+     * move, but the background thread may be calling cuMemMap/cuMemSetAccess while
+     * that happens: capture with capture_error_mode="thread_local" or sync first.
+     */
     void step_async(std::vector<u64> seq_lens)
     {
-        set_curr_seq_lengths(seq_lens);
-        /* synchronize with the background thread first */
+        /* synchronize with the background thread first, it reads curr_seq_lengths */
         wait_kvcache_manager_sync();
+        set_curr_seq_lengths(seq_lens);
         /* allocate prefill memory synchronously, if required */
         prepare_prefill_kvcache();
         /* allocate decode memory for next step asynchronously */
         spawn_kvcache_manager();
     }
 
+    /* same as above but reads sequence lengths from a caller-owned int32 buffer */
+    void step_async(const int32_t *seq_lens, int num_seqs)
+    {
+        /* the background thread reads curr_seq_lengths, so wait before updating it in place */
+        wait_kvcache_manager_sync();
+        set_curr_seq_lengths(seq_lens, num_seqs);
+        prepare_prefill_kvcache();
+        spawn_kvcache_manager();
+    }
+
+    /* same as above but for active requests given as parallel arrays of batch ids and sequence lengths */
+    void step_async(const int32_t *batch_ids, const int32_t *seq_lens, int num_seqs)
+    {
+        wait_kvcache_manager_sync();
+        set_curr_seq_lengths(batch_ids, seq_lens, num_seqs);
+        prepare_prefill_kvcache();
+        spawn_kvcache_manager();
+    }
+
+    /*
+     * Run num_steps decode iterations of step_async in one call. Each iteration
+     * grows every active request by one token before stepping, which is what the
+     * framework would do after every forward pass.
+     */
+    void step_async_range(std::vector<u64> seq_lens, int num_steps)
+    {
+        for (int step = 0; step < num_steps; step++)
+        {
+            for (auto &seq_len : seq_lens)
+                if (seq_len != 0)
+                    seq_len++;
+            step_async(seq_lens);
+        }
+    }
+
+    void step_async_range(const int32_t *batch_ids, const int32_t *seq_lens, int num_seqs, int num_steps)
+    {
+        std::vector<u64> lens;
+        scatter_seq_lengths(batch_ids, seq_lens, num_seqs, lens);
+        step_async_range(lens, num_steps);
+    }
+
     /*
      * Return one of the inactive ids using best fit.
      * NOTE: the caller is supposed to check if the returned reqId is valid or not
@@ -568,6 +667,8 @@ public:
         int new_id = -1;
         u64 nr_required = tokens_to_pages(seqlen);
 
+        wait_kvcache_manager_sync();
+
         for (int reqId = 0; reqId < max_batch_size; reqId++)
         {
             if (is_active_req(reqId))
@@ -590,8 +691,37 @@ public:
         return new_id;
     }
 
+    /*
+     * Same as alloc_new_batch_idx but also maps the pages required for prefill
+     * right away, so that the next step does not have to do it.
+     */
+    int alloc_and_bind(u64 seqlen)
+    {
+        int reqId = alloc_new_batch_idx(seqlen);
+
+        if (reqId == -1)
+            return reqId;
+
+        /* the slot may already hold pages from a previous request, keep those on failure */
+        u64 nr_mapped = get_req_pages(reqId);
+        try
+        {
+            map_pages_for_curr_step(reqId, seqlen);
+        }
+        catch (...)
+        {
+            /* the caller never sees reqId, so the slot must not stay active */
+            release_kvcache_pages_some(reqId, nr_mapped);
+            set_req_seq_length(reqId, 0);
+            throw;
+        }
+
+        return reqId;
+    }
+
     void free_batch_idx(int reqId)
     {
+        wait_kvcache_manager_sync();
         set_req_seq_length(reqId, 0);
     }
 
@@ -631,9 +761,18 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m)
     m.def("step", &step, "step function...");
     m.def("map_common_pages", &map_common_pages, "map common pages in batch...");
     /* API for actual physical memory allocation - one call per iteration */
+    m.def("step_async", &step_async_tensor, "single step function for the async version (integer tensor)...");
+    m.def("step_async", &step_async_batched, "single step function for the async version (batch ids, seq lens)...",
+          py::arg("batch_ids").noconvert(), py::arg("seq_lens").noconvert());
+    m.def("step_async", &step_async_numpy, "single step function for the async version (int32 numpy array)...",
+          py::arg("seq_lens").noconvert());
     m.def("step_async", &step_async, "single step function for the async version...");
+    m.def("step_async_range", &step_async_range_batched, "multiple decode steps of the async version (batch ids, seq lens)...",
+          py::arg("batch_ids").noconvert(), py::arg("seq_lens").noconvert(), py::arg("num_steps"));
+    m.def("step_async_range", &step_async_range, "multiple decode steps of the async version in one call...");
     /* Request-level APIs */
     m.def("alloc_new_batch_idx", &alloc_new_batch_idx, "allocate a request id...");
+    m.def("alloc_and_bind", &alloc_and_bind, "allocate a request id and map its prefill pages...");
     m.def("free_batch_idx", &free_batch_idx, "free a request id...");
     m.def("num_free_kvblocks", &num_free_kvblocks, "number of free kv blocks...");
 }